@@ -7,14 +7,30 @@ import json
 import re
 import shutil
 import logging
+import queue
+import socketserver
+import threading
+import uuid
+import zipfile
 from pathlib import Path
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
 import undetected_chromedriver as uc
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
 
+# 可选依赖：watchdog（Linux 下基于 inotify），未安装时监控模式退回到 mtime 轮询
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
 # ---------------- 配置区 ----------------
 # 根目录配置 - 会遍历这个目录下的所有子目录
 ROOT_DIRECTORY = os.path.abspath("")  # 修改为你的根目录
@@ -38,10 +54,83 @@ DOWNLOAD_TIMEOUT = 120
 MENU_WAIT = 2
 CLICK_WAIT = 1
 PAGE_STABLE_WAIT = 3
+DOC_INTERVAL_WAIT = 2  # 文档之间的间隔
+EXPORT_STEP_TIMEOUT = 5  # 导出菜单每一步等待元素的超时
+CONFIRM_WAIT = 2  # 选择导出类型后等待确认弹窗
+DIR_INTERVAL_WAIT = 3  # 目录之间的间隔
 
 # 下载记录文件
 DOWNLOAD_LOG_FILE = "downloaded_files.txt"
 
+# 导出方式：True 时注入脚本在页面内一次完成菜单点击，失败时退回逐步点击
+SCRIPTED_EXPORT = True
+SELECTOR_CACHE_FILE = "selector_cache.json"  # 保存在根目录，记录每种文档上次成功的 XPath
+
+# 运行指标（Prometheus 文本格式），端口为 0 时不启动 HTTP 服务
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0  # 例如 9108，访问 http://127.0.0.1:9108/metrics
+
+# 耗时历史（保存在根目录，用于预估运行时间和 ETA）
+TIMING_HISTORY_FILE = "download_history.json"
+DEFAULT_DOC_SECONDS = 30  # 没有任何历史数据时的单文档预估耗时
+THROUGHPUT_WINDOW = 20  # 滚动吞吐量按最近多少个文档计算
+
+# 调度策略："listed" 按 data.json 顺序；"shortest" 预估耗时短的优先（尽快出结果）；
+# "longest" 预估耗时长的优先（多个 worker 时负载更均衡）
+SCHEDULE_STRATEGY = "listed"
+DEFER_FLAKY = False  # 把经常失败的文档推迟到整个运行的最后（守护进程中为任务的最后）
+FLAKY_FAILURE_RATE = 0.5  # 历史失败率达到该值且至少失败 FLAKY_MIN_FAILURES 次视为不稳定
+FLAKY_MIN_FAILURES = 2
+
+# 运行模式："download" 正常下载；"plan" 只预估待处理文档的运行时间，不启动浏览器；
+# "daemon" 常驻浏览器并通过本地接口接收下载任务；"watch" 在 daemon 基础上监控 data.json 变化
+RUN_MODE = "download"
+
+# 守护进程配置
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 8765
+DAEMON_SOCKET = ""  # 设置后改为监听 Unix socket，例如 "/tmp/qiwei_download.sock"
+DAEMON_WORKERS = 1  # 常驻浏览器数量（使用真实 Profile 时只能为 1）
+DAEMON_MAX_JOBS = 500  # 内存中最多保留的任务数
+
+# 监控模式配置
+WATCH_STATE_FILE = ".watch_state.json"  # 保存在根目录，记录每个 data.json 中已处理的文档
+WATCH_DEBOUNCE = 2  # data.json 停止变化多少秒后再解析
+WATCH_POLL_INTERVAL = 10  # 未安装 watchdog 时的轮询间隔
+WATCH_RETRY_DELAY = 60  # 任务中止（如登录失效）后，多少秒后重新比对对应的 data.json
+
+# 登录失效检测
+SESSION_PROBE_URL = "https://doc.weixin.qq.com/"  # 检查登录状态时打开的页面
+LOGIN_PATH_SEGMENTS = {"login", "sso", "passport", "wwlogin"}  # URL 路径中出现这些段视为登录页
+# 登录页特有的元素（扫码登录二维码容器），不匹配标题或正文，避免文档名里带"登录"被误判
+LOGIN_PAGE_SELECTORS = (
+    "iframe[src*='login.work.weixin.qq.com']",
+    "iframe[src*='wwlogin']",
+    "#wwLogin",
+    ".login_qrcode",
+    ".wwLogin_qrcode",
+)
+SESSION_CHECK_FAILURES = 3  # 连续失败多少次后主动检查登录状态
+REAUTH_ATTEMPTS = 2  # 登录失效时重新认证的次数
+SESSION_PROBE_CACHE = 60  # 登录状态检查通过后多少秒内不再重复检查（页面分类判定无权限时使用）
+
+# 页面分类：打开文档后快速判断已删除 / 无权限 / 不支持的页面，不再等待完整的导出超时
+CLASSIFY_PAGES = True  # 需要 Chrome 性能日志读取 HTTP 状态码
+PAGE_CLASSIFY_POLL = 0.1  # 检查间隔（秒），最长等待 PAGE_STABLE_WAIT
+NOT_FOUND_MARKERS = ("文档不存在", "文件不存在", "已被删除", "已删除", "链接已失效", "找不到该文档")
+NO_PERMISSION_MARKERS = ("无权限", "没有权限", "暂无权限", "无访问权限", "申请权限", "申请访问")
+UNSUPPORTED_PATH_SEGMENTS = {"slide", "mind", "form", "flowchart"}  # 不支持导出的文档类型
+RETRY_PERMANENT_FAILURES = False  # True 时忽略历史中的永久失败记录，重新打开这些文档
+PERMANENT_FAILURE_TTL_DAYS = 30  # 永久失败记录的有效天数，过期后重新尝试；0 表示永不过期
+
+# 调试文件（失败时的页面源码和截图），压缩后保存在下载目录之外
+DEBUG_DIR = os.path.join(os.path.expanduser("~"), ".cache", "qiwei_doc_download", "debug")
+DEBUG_SAMPLES_PER_REASON = 3  # 每次运行（守护进程中为每个任务）每种失败原因最多保存几份
+DEBUG_MAX_ARTIFACTS = 200  # 最多保留多少份，超出后删除最旧的
+
+# 工具自身写在根目录的文件，等待下载时不能当作新下载的文件
+STATE_FILES = {DOWNLOAD_LOG_FILE, TIMING_HISTORY_FILE, SELECTOR_CACHE_FILE}
+
 # ---------------------------------------------------------
 
 # 配置日志格式
@@ -77,12 +166,146 @@ def format_time(seconds):
         return f"{int(seconds // 3600)}小时{int((seconds % 3600) // 60)}分"
 
 
-def print_progress_bar(current, total, prefix='', length=50):
+def print_progress_bar(current, total, prefix='', length=50, suffix=''):
     """打印进度条"""
-    percent = current / total
+    percent = current / total if total else 1.0
     filled = int(length * percent)
     bar = '█' * filled + '░' * (length - filled)
-    logging.info(f"{prefix} [{bar}] {current}/{total} ({percent*100:.1f}%)")
+    line = f"{prefix} [{bar}] {current}/{total} ({percent*100:.1f}%)"
+    if suffix:
+        line += f" {suffix}"
+    logging.info(line)
+
+
+class Metrics:
+    """线程安全的运行指标，按 Prometheus 文本格式导出"""
+
+    LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+    HELP = {
+        "qiwei_documents_total": ("counter", "按结果和原因统计的文档数"),
+        "qiwei_exports_in_flight": ("gauge", "正在导出的文档数"),
+        "qiwei_phase_duration_seconds": ("histogram", "各阶段耗时（秒）"),
+        "qiwei_downloaded_bytes_total": ("counter", "已下载的字节数"),
+        "qiwei_directory_documents": ("gauge", "各目录的文档数（total/done）"),
+        "qiwei_directories": ("gauge", "目录数（total/done）"),
+        "qiwei_run_start_timestamp_seconds": ("gauge", "本次运行开始时间"),
+        "qiwei_daemon_jobs": ("gauge", "守护进程中排队/运行中的任务数"),
+        "qiwei_daemon_jobs_finished_total": ("counter", "守护进程已结束的任务数"),
+        "qiwei_debug_artifacts_total": ("counter", "调试文件采集结果（saved/sampled_out/error）"),
+        "qiwei_session_events_total": ("counter", "登录失效与重新认证事件"),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def add(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(self.LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        parts = []
+        for k, v in labels:
+            v = v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{k}="{v}"')
+        return "{" + ",".join(parts) + "}"
+
+    def render(self):
+        """生成 Prometheus 文本格式"""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self._histograms.items()}
+
+        by_name = {}
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            by_name.setdefault(name, []).append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms.items():
+            lines = by_name.setdefault(name, [])
+            for bound, bucket_count in zip(self.LATENCY_BUCKETS, buckets):
+                le = labels + (("le", str(bound)),)
+                lines.append(f"{name}_bucket{self._format_labels(le)} {bucket_count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+
+        out = []
+        for name in sorted(by_name):
+            metric_type, help_text = self.HELP.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {metric_type}")
+            out.extend(by_name[name])
+        return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+
+
+def metric_reason(status):
+    """把失败原因归一为低基数的指标标签（去掉异常详情）"""
+    return str(status).split(":")[0].strip() or "未知"
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """在后台线程启动 /metrics 端点"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = METRICS.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logging.warning(f"⚠️  启动指标服务失败: {e}")
+        return None
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"📡 指标服务已启动: http://{host}:{server.server_address[1]}/metrics")
+    return server
 
 
 def log_downloaded_file(filepath, filename):
@@ -99,6 +322,180 @@ def log_downloaded_file(filepath, filename):
         logging.warning(f"⚠️  写入下载日志失败: {e}")
 
 
+class TimingHistory:
+    """跨运行保存每个文档的耗时、大小和失败次数"""
+
+    MAX_SAMPLES = 5  # 每个文档保留最近几次耗时
+
+    def __init__(self, path):
+        self.path = path
+        self.docs = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.docs = data.get("docs", {})
+            logging.info(f"📚 已加载 {len(self.docs)} 条耗时历史")
+        except Exception as e:
+            logging.warning(f"⚠️  读取耗时历史失败: {e}")
+
+    def save(self):
+        # 临时文件以 . 开头，不会被 wait_for_new_download 当作新下载
+        tmp_path = os.path.join(os.path.dirname(self.path), f".{os.path.basename(self.path)}.tmp")
+        try:
+            with self._lock:
+                data = {"docs": dict(self.docs)}
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.warning(f"⚠️  保存耗时历史失败: {e}")
+
+    def record(self, url, duration, success, status, size=None):
+        """记录一次文档处理结果"""
+        with self._lock:
+            entry = self.docs.setdefault(url, {
+                "type": guess_ext_from_url(url),
+                "durations": [],
+                "attempts": 0,
+                "failures": 0,
+            })
+            entry["durations"] = (entry["durations"] + [round(duration, 2)])[-self.MAX_SAMPLES:]
+            entry["attempts"] += 1
+            if not success:
+                entry["failures"] += 1
+            if size is not None:
+                entry["size"] = size
+            entry["last_status"] = status
+            entry["last_time"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def get(self, url):
+        return self.docs.get(url)
+
+    def permanent_failure(self, url):
+        """已判定为不存在 / 无权限 / 不支持的文档，返回失败原因；记录过期或设置了重试时返回 None"""
+        if RETRY_PERMANENT_FAILURES:
+            return None
+        entry = self.docs.get(url) or {}
+        status = entry.get("last_status")
+        if status not in PERMANENT_FAILURES:
+            return None
+        if PERMANENT_FAILURE_TTL_DAYS > 0:
+            try:
+                recorded = datetime.strptime(entry.get("last_time", ""), '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                return None
+            if (datetime.now() - recorded).total_seconds() > PERMANENT_FAILURE_TTL_DAYS * 86400:
+                return None
+        return status
+
+    def is_flaky(self, url):
+        """历史上经常失败的文档"""
+        entry = self.docs.get(url)
+        if not entry or entry.get("failures", 0) < FLAKY_MIN_FAILURES:
+            return False
+        return entry["failures"] / max(entry.get("attempts", 1), 1) >= FLAKY_FAILURE_RATE
+
+    def type_average(self, ext):
+        """某种类型（xlsx/docx/bin）文档的平均耗时"""
+        with self._lock:
+            samples = [sum(e["durations"]) / len(e["durations"])
+                       for e in self.docs.values()
+                       if e.get("type") == ext and e.get("durations")]
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+    def estimate(self, url, type_averages=None):
+        """预估单个文档耗时：优先用该文档的历史，其次用同类型平均值"""
+        entry = self.docs.get(url)
+        if entry and entry.get("durations"):
+            return sum(entry["durations"]) / len(entry["durations"])
+        ext = guess_ext_from_url(url)
+        if type_averages is not None:
+            avg = type_averages.get(ext)
+        else:
+            avg = self.type_average(ext)
+        return avg if avg is not None else DEFAULT_DOC_SECONDS
+
+    def type_averages(self):
+        return {ext: self.type_average(ext) for ext in ("xlsx", "docx", "bin")}
+
+    def plan(self, pending):
+        """预估待处理文档的耗时（plan 模式与运行中的 ETA 共用）
+
+        返回 ({doc_url: 秒数（含文档间隔）}, 目录间隔总秒数)
+        """
+        type_averages = self.type_averages()
+        estimates = {
+            url: self.estimate(url, type_averages) + DOC_INTERVAL_WAIT
+            for urls in pending.values() for url in urls
+        }
+        overhead = DIR_INTERVAL_WAIT * max(len(pending) - 1, 0)
+        return estimates, overhead
+
+
+class ProgressTracker:
+    """根据历史预估和实际完成情况计算滚动吞吐量与 ETA"""
+
+    def __init__(self, estimates, overhead=0):
+        # estimates: doc_url -> 预估秒数（本次待处理的文档，含文档间隔），overhead: 目录间隔总秒数
+        self.estimates = dict(estimates)
+        self.total = len(self.estimates)
+        self.overhead = overhead
+        self.remaining_estimate = sum(self.estimates.values())
+        self.done = 0
+        self.actual_spent = 0.0
+        self.estimated_spent = 0.0
+        self.recent = []  # 最近完成时间戳
+        self.start = time.time()
+
+    def complete(self, url, duration):
+        estimate = self.estimates.pop(url, None)
+        if estimate is not None:
+            self.remaining_estimate -= estimate
+            self.estimated_spent += estimate
+            # 预估里包含文档间隔，实际耗时也按同样口径计算
+            self.actual_spent += duration + DOC_INTERVAL_WAIT
+        self.done += 1
+        self.recent = (self.recent + [time.time()])[-THROUGHPUT_WINDOW:]
+
+    def complete_directory(self):
+        self.overhead = max(self.overhead - DIR_INTERVAL_WAIT, 0)
+
+    def throughput(self):
+        """最近窗口内的吞吐量（文档/分钟）"""
+        if len(self.recent) >= 2:
+            span = self.recent[-1] - self.recent[0]
+            if span >= 1:
+                return (len(self.recent) - 1) * 60 / span
+        elapsed = time.time() - self.start
+        if self.done and elapsed > 0:
+            return self.done * 60 / elapsed
+        return None
+
+    def eta(self):
+        """剩余时间（秒），用已完成文档的实际/预估比例校正历史预估"""
+        remaining = max(self.remaining_estimate, 0)
+        if self.estimated_spent > 0 and self.done >= 3:
+            ratio = self.actual_spent / self.estimated_spent
+            remaining *= min(max(ratio, 0.2), 5.0)
+        return remaining + self.overhead
+
+    def summary(self):
+        parts = []
+        rate = self.throughput()
+        if rate is not None:
+            parts.append(f"{rate:.1f} 个/分")
+        parts.append(f"ETA {format_time(self.eta())}")
+        return "| " + " | ".join(parts)
+
+
 def setup_browser(download_path, use_profile=False, profile_path="", profile_name="Default"):
     """设置浏览器"""
     options = uc.ChromeOptions()
@@ -121,6 +518,10 @@ def setup_browser(download_path, use_profile=False, profile_path="", profile_nam
     }
     options.add_experimental_option("prefs", prefs)
     
+    # 性能日志用于页面分类时读取文档请求的 HTTP 状态码
+    if CLASSIFY_PAGES:
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    
     # 使用真实浏览器 Profile
     if use_profile and profile_path:
         logging.info(f"使用真实浏览器 Profile: {profile_path}/{profile_name}")
@@ -140,7 +541,8 @@ def setup_browser(download_path, use_profile=False, profile_path="", profile_nam
         )
         
         driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
-        driver.set_script_timeout(30)
+        # 导出脚本会在页面内等待菜单、导出、类型和确认四步
+        driver.set_script_timeout(max(30, WAIT_TIMEOUT + 2 * EXPORT_STEP_TIMEOUT + CONFIRM_WAIT + 5))
         
         logging.info("✅ 浏览器启动成功")
         return driver
@@ -150,6 +552,38 @@ def setup_browser(download_path, use_profile=False, profile_path="", profile_nam
         raise
 
 
+def start_browser_session(download_path=None, interactive=True):
+    """启动浏览器并完成登录（cookie 注入或真实 Profile）
+
+    interactive 为 False 时（守护进程）不等待手动登录，没有 cookie 直接报错。
+    """
+    if not interactive and not USE_REAL_PROFILE and not (
+            os.path.exists(cookie_file) and load_cookies_from_file(cookie_file)):
+        raise RuntimeError(f"未提供 cookie（{cookie_file}）且未使用 profile，无法在后台登录")
+    
+    driver = setup_browser(
+        download_path or ROOT_DIRECTORY,  # 初始下载目录设为根目录
+        use_profile=USE_REAL_PROFILE,
+        profile_path=CHROME_PROFILE_PATH,
+        profile_name=PROFILE_NAME
+    )
+    
+    # 如果不使用 profile，则需要加载 cookie
+    if not USE_REAL_PROFILE:
+        cookies_list = load_cookies_from_file(cookie_file) if os.path.exists(cookie_file) else []
+        if cookies_list:
+            logging.info(f"🔐 正在注入 {len(cookies_list)} 个 cookie...")
+            add_cookies(driver, cookies_list)
+        else:
+            logging.warning("⚠️  未提供 cookie 且未使用 profile，可能需要手动登录")
+            logging.info("👉 请在打开的浏览器中登录，然后按回车继续...")
+            input()
+    else:
+        logging.info("✅ 使用真实浏览器 Profile，已自动登录")
+    
+    return driver
+
+
 def load_cookies_from_file(path: str) -> list:
     """从 JSON 文件读取 cookie"""
     try:
@@ -214,6 +648,272 @@ def add_cookies(driver, cookies_list, domain="doc.weixin.qq.com"):
     time.sleep(2)
 
 
+SESSION_EXPIRED_STATUS = "登录失效"
+
+
+def is_login_page(driver):
+    """判断当前页面是否为登录页：跳转到了登录地址，或页面上有扫码登录的二维码容器"""
+    try:
+        parsed = urlparse(driver.current_url or "")
+        segments = {seg.split(".")[0] for seg in parsed.path.lower().split("/") if seg}
+        if segments & LOGIN_PATH_SEGMENTS or parsed.netloc.lower().startswith("login."):
+            return True
+        
+        return bool(driver.execute_script(
+            "if (document.getElementById('main-menu-file')) return false;"
+            "return arguments[0].some(function (sel) {"
+            " try { return !!document.querySelector(sel); } catch (e) { return false; } });",
+            list(LOGIN_PAGE_SELECTORS),
+        ))
+    except Exception as e:
+        logging.debug(f"检查登录页时出错: {e}")
+        return False
+
+
+def probe_session(driver):
+    """打开 SESSION_PROBE_URL 检查登录状态是否有效"""
+    try:
+        driver.get(SESSION_PROBE_URL)
+        time.sleep(PAGE_STABLE_WAIT)
+    except Exception as e:
+        logging.warning(f"⚠️  检查登录状态失败: {e}")
+        return False
+    return not is_login_page(driver)
+
+
+def reauthenticate(driver):
+    """重新读取 cookie_file 注入 cookie；使用真实 Profile 时重新打开首页让会话续期"""
+    if USE_REAL_PROFILE:
+        return True
+    
+    cookies_list = load_cookies_from_file(cookie_file) if os.path.exists(cookie_file) else []
+    if not cookies_list:
+        logging.warning("⚠️  没有可用的 cookie，无法重新认证")
+        return False
+    
+    try:
+        driver.delete_all_cookies()
+        add_cookies(driver, cookies_list)
+        return True
+    except Exception as e:
+        logging.warning(f"⚠️  重新注入 cookie 失败: {e}")
+        return False
+
+
+class SessionGate:
+    """多个 worker 共享的登录状态：同一时间只有一个 worker 重新认证，全部结束后才放行队列"""
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.ready.set()
+        self.lock = threading.Lock()
+        self.generation = 0     # 每完成一次重新认证加一
+        self.last_ok = True
+        self.probed_at = 0.0    # 上次确认登录有效的时间
+        self._recovering = 0
+        self._count_lock = threading.Lock()
+
+    def enter(self):
+        with self._count_lock:
+            self._recovering += 1
+            self.ready.clear()
+
+    def leave(self):
+        with self._count_lock:
+            self._recovering -= 1
+            if self._recovering == 0:
+                self.ready.set()
+
+
+class SessionGuard:
+    """检测登录失效：导航后检查是否跳到登录页，连续失败后主动探测；失效时暂停队列并尝试重新认证"""
+
+    def __init__(self, gate=None):
+        # gate 在多个 worker 间共享，重新认证期间其他 worker 不再开始新文档
+        self.gate = gate or SessionGate()
+        self.consecutive_failures = 0
+
+    def wait_ready(self):
+        self.gate.ready.wait()
+
+    def after_navigation(self, driver, url):
+        """打开文档后调用，返回 False 表示登录失效且无法恢复"""
+        if not is_login_page(driver):
+            return True
+        
+        logging.warning("🔐 页面跳转到了登录页，登录可能已失效")
+        if not self.recover(driver):
+            return False
+        driver.get(url)
+        return not is_login_page(driver)
+
+    def record(self, driver, success):
+        """记录文档结果，连续失败达到阈值时检查登录状态；返回 False 表示登录失效且无法恢复"""
+        if success:
+            self.consecutive_failures = 0
+            return True
+        
+        self.consecutive_failures += 1
+        if self.consecutive_failures < SESSION_CHECK_FAILURES:
+            return True
+        
+        self.consecutive_failures = 0
+        logging.info(f"🔍 连续失败 {SESSION_CHECK_FAILURES} 次，检查登录状态...")
+        if probe_session(driver):
+            logging.info("✅ 登录状态正常")
+            self.gate.probed_at = time.time()
+            return True
+        
+        logging.warning("🔐 登录已失效")
+        return self.recover(driver)
+
+    def session_ok(self, driver):
+        """确认登录有效；SESSION_PROBE_CACHE 秒内确认过则直接返回，避免每个无权限文档都打开一次首页"""
+        if time.time() - self.gate.probed_at < SESSION_PROBE_CACHE:
+            return True
+        if not probe_session(driver):
+            return False
+        self.gate.probed_at = time.time()
+        return True
+
+    def recover(self, driver):
+        """暂停队列并重新认证；多个 worker 同时失效时依次进行，只有第一个完整重试"""
+        METRICS.inc("qiwei_session_events_total", event="expired")
+        gate = self.gate
+        seen = gate.generation
+        gate.enter()
+        try:
+            with gate.lock:
+                if gate.generation != seen:
+                    # 等锁期间其他 worker 已经完成重新认证
+                    if not gate.last_ok:
+                        logging.error("❌ 其他 worker 重新认证失败，不再重复尝试")
+                        return False
+                    # 每个浏览器有自己的 cookie，只需载入一次刷新后的 cookie
+                    attempts = 1
+                else:
+                    attempts = REAUTH_ATTEMPTS
+                
+                ok = False
+                for attempt in range(1, attempts + 1):
+                    logging.info(f"🔐 尝试重新认证（{attempt}/{attempts}）...")
+                    if reauthenticate(driver) and probe_session(driver):
+                        ok = True
+                        break
+                gate.generation += 1
+                gate.last_ok = ok
+                
+                if ok:
+                    gate.probed_at = time.time()
+                    logging.info("✅ 重新认证成功，继续处理")
+                    METRICS.inc("qiwei_session_events_total", event="reauth_ok")
+                else:
+                    logging.error("❌ 重新认证失败，请更新 cookie 或重新登录 Profile")
+                    METRICS.inc("qiwei_session_events_total", event="reauth_failed")
+                return ok
+        finally:
+            gate.leave()
+
+
+# 页面分类结果对应的失败原因，这些文档以后不再重试
+PAGE_CLASS_FAILURES = {
+    "not_found": "文档不存在",
+    "no_permission": "无权限",
+    "unsupported": "不支持的链接",
+}
+PERMANENT_FAILURES = set(PAGE_CLASS_FAILURES.values())
+
+
+def drain_network_log(driver):
+    """读取并清空 Chrome 性能日志"""
+    try:
+        return driver.get_log("performance")
+    except Exception:
+        return []
+
+
+def document_status(entries, final_url):
+    """从性能日志中找出最终页面文档请求的 HTTP 状态码"""
+    final_url = str(final_url).split("#")[0]
+    first_status = None
+    for entry in entries:
+        try:
+            message = json.loads(entry["message"])["message"]
+        except (KeyError, TypeError, ValueError):
+            continue
+        if message.get("method") != "Network.responseReceived":
+            continue
+        params = message.get("params", {})
+        if params.get("type") != "Document":
+            continue
+        response = params.get("response", {})
+        if response.get("url", "").split("#")[0] == final_url:
+            return response.get("status")
+        if first_status is None:
+            first_status = response.get("status")
+    return first_status
+
+
+def is_unsupported_url(url):
+    """只根据原始文档链接判断是否为不支持导出的链接（跳转后的地址不可靠）"""
+    if guess_ext_from_url(url) == "bin":
+        return True
+    segments = [seg for seg in urlparse(url).path.lower().split("/") if seg]
+    return bool(segments) and segments[0] in UNSUPPORTED_PATH_SEGMENTS
+
+
+def classify_page(driver, session=None, timeout=None):
+    """打开文档后快速判断页面类型：ready / login / not_found / no_permission / unknown"""
+    timeout = PAGE_STABLE_WAIT if timeout is None else timeout
+    deadline = time.time() + timeout
+    entries = []
+    
+    while True:
+        entries.extend(drain_network_log(driver))
+        try:
+            final_url = driver.current_url or ""
+            page = driver.execute_script(
+                "var menu = !!document.getElementById('main-menu-file');"
+                "return {menu: menu, text: menu || !document.body ? '' : document.body.innerText.slice(0, 3000)};"
+            ) or {}
+        except Exception as e:
+            logging.debug(f"页面分类时出错: {e}")
+            return "unknown"
+        
+        if page.get("menu"):
+            return "ready"
+        
+        status = document_status(entries, final_url)
+        expired = time.time() >= deadline
+        if status in (404, 410):
+            label = "not_found"
+        elif status in (401, 403):
+            label = "no_permission"
+        elif not expired:
+            # 菜单还没渲染时正文可能是文档自己的内容（标题就是文档名，不参与判断），超时仍没有菜单才按页面文字判断
+            label = None
+        elif any(marker in page.get("text") or "" for marker in NOT_FOUND_MARKERS):
+            label = "not_found"
+        elif any(marker in page.get("text") or "" for marker in NO_PERMISSION_MARKERS):
+            label = "no_permission"
+        else:
+            label = None
+        
+        # 登录失效时同样会出现 401/403、"申请权限"或延迟跳转，先排除登录页再下结论
+        if label:
+            if is_login_page(driver):
+                return "login"
+            # 无权限页面和会话过期的页面可能完全相同，确认登录状态后才能记为永久失败
+            if label == "no_permission":
+                if not (session.session_ok(driver) if session else probe_session(driver)):
+                    return "login"
+            return label
+        
+        if expired:
+            return "login" if is_login_page(driver) else "unknown"
+        time.sleep(PAGE_CLASSIFY_POLL)
+
+
 def wait_for_new_download(before_files, download_folder, timeout=DOWNLOAD_TIMEOUT):
     """等待下载完成 - 改进版本"""
     start = time.time()
@@ -252,7 +952,8 @@ def wait_for_new_download(before_files, download_folder, timeout=DOWNLOAD_TIMEOU
                           if not f.endswith('.crdownload') 
                           and not f.endswith('.tmp')
                           and not f.startswith('.')
-                          and not f.startswith('~')]
+                          and not f.startswith('~')
+                          and f not in STATE_FILES]
             
             if not valid_files:
                 logging.debug("   只有临时文件，继续等待...")
@@ -306,7 +1007,8 @@ def wait_for_new_download(before_files, download_folder, timeout=DOWNLOAD_TIMEOU
         if final_new:
             # 返回最新的非临时文件
             valid = [Path(download_folder) / f for f in final_new 
-                    if not f.endswith(('.crdownload', '.tmp')) and not f.startswith('.')]
+                    if not f.endswith(('.crdownload', '.tmp')) and not f.startswith('.')
+                    and f not in STATE_FILES]
             if valid:
                 latest = max(valid, key=lambda f: f.stat().st_mtime)
                 logging.info(f"✅ 找到文件: {latest.name}")
@@ -329,208 +1031,794 @@ def update_download_directory(driver, new_download_path):
         logging.warning(f"⚠️  更新下载目录失败: {e}")
 
 
-def save_debug(driver, prefix, current_dir=None):
-    """保存调试信息"""
-    debug_dir = os.path.join(current_dir if current_dir else "debug", "debug")
-    os.makedirs(debug_dir, exist_ok=True)
-    
-    ts = int(time.time())
-    html_path = os.path.join(debug_dir, f"{prefix}_{ts}.html")
-    png_path = os.path.join(debug_dir, f"{prefix}_{ts}.png")
-    
-    try:
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(driver.page_source)
-        driver.save_screenshot(png_path)
-        logging.info(f"💾 已保存调试文件：{html_path}, {png_path}")
-    except Exception as e:
-        logging.warning(f"⚠️  保存调试文件失败: {e}")
+class DiagnosticsSampler:
+    """一次运行（或守护进程中的一个任务）的抽样状态"""
 
+    def __init__(self, samples_per_reason=None):
+        self.samples_per_reason = DEBUG_SAMPLES_PER_REASON if samples_per_reason is None else samples_per_reason
+        self.counts = {}  # 每种原因已采集的份数
+        self.dropped = {}  # 每种原因因抽样未保存的份数
+        self.artifacts = []  # 本次采集的调试文件路径
+        self._lock = threading.Lock()
 
-def check_file_exists(directory, filename, url):
-    """检查文件是否已存在"""
-    # 获取期望的文件扩展名
-    ext = guess_ext_from_url(url)
-    full_filename = f"{safe_filename(filename)}.{ext}"
-    file_path = Path(directory) / full_filename
-    
-    if file_path.exists():
-        logging.info(f"⏭️  文件已存在，跳过: {full_filename}")
-        return True
-    
-    # 检查是否有带编号的版本
-    i = 1
-    while True:
-        alt_filename = f"{safe_filename(filename)}({i}).{ext}"
-        alt_path = Path(directory) / alt_filename
-        if alt_path.exists():
-            logging.info(f"⏭️  文件已存在，跳过: {alt_filename}")
-            return True
-        if not alt_path.exists():
-            break
-        i += 1
-    
-    return False
+    def allow(self, reason):
+        with self._lock:
+            if self.counts.get(reason, 0) < self.samples_per_reason:
+                return True
+            self.dropped[reason] = self.dropped.get(reason, 0) + 1
+            return False
 
+    def taken(self, reason, path):
+        with self._lock:
+            self.counts[reason] = self.counts.get(reason, 0) + 1
+            self.artifacts.append(path)
 
-def click_export_and_download(driver, name, url, idx, total, download_dir, before_files):
-    """点击导出并下载 - 改进版本"""
-    
-    url_l = url.lower()
-    is_sheet = "sheet" in url_l
-    is_doc = "doc" in url_l and "sheet" not in url_l
-    
-    doc_type = "表格" if is_sheet else "文档" if is_doc else "文件"
-    
-    try:
-        # 1. 点击菜单
-        logging.info(f"🔍 [{idx}/{total}] 查找菜单按钮...")
-        menu = WebDriverWait(driver, WAIT_TIMEOUT).until(
-            EC.element_to_be_clickable((By.ID, "main-menu-file"))
-        )
-        menu.click()
-        logging.info(f"✅ 菜单按钮已点击")
-        time.sleep(MENU_WAIT)
-        
-        # 2. 点击导出
-        logging.info(f"🔍 查找导出按钮...")
-        if is_sheet:
-            export_xpaths = [
-                "//li[contains(@class,'mainmenu-submenu-exportAs') and contains(normalize-space(.),'导出')]",
-                "//li[contains(@class,'mainmenu-submenu') and contains(normalize-space(.),'导出')]",
-            ]
-        else:
-            export_xpaths = [
-                "//li[contains(@class,'mainmenu-submenu-export-as') and contains(normalize-space(.),'导出')]",
-                "//li[contains(@class,'mainmenu-submenu') and contains(normalize-space(.),'导出')]",
-            ]
-        
-        export_li = None
-        for xpath_idx, xpath in enumerate(export_xpaths, 1):
-            try:
-                logging.debug(f"   尝试 XPath {xpath_idx}/{len(export_xpaths)}")
-                export_li = WebDriverWait(driver, 5).until(
-                    EC.element_to_be_clickable((By.XPATH, xpath))
-                )
-                logging.info(f"✅ 找到导出按钮（XPath {xpath_idx}）")
-                break
-            except TimeoutException:
-                continue
-        
-        if not export_li:
-            return None, "未找到导出按钮"
-        
-        export_li.click()
-        logging.info(f"✅ 导出按钮已点击")
-        time.sleep(CLICK_WAIT)
-        
-        # 3. 选择导出类型
-        logging.info(f"🔍 查找导出类型选项（{doc_type}）...")
-        if is_sheet:
-            export_type_xpaths = [
-                "//li[contains(@class,'mainmenu-item-export-local') and contains(normalize-space(.),'本地')]",
-                "//li[contains(@class,'export-local') and contains(normalize-space(.),'本地')]",
-            ]
-        elif is_doc:
-            export_type_xpaths = [
-                "//li[contains(@class,'mainmenu-item-export-as-docx') and contains(normalize-space(.),'本地')]",
-                "//li[contains(@class,'export-as-docx') and contains(normalize-space(.),'本地')]",
-            ]
-        else:
-            export_type_xpaths = [
-                "//*[contains(normalize-space(.),'本地') and (self::li or self::button)]",
-            ]
-        
-        target = None
-        for xpath_idx, xpath in enumerate(export_type_xpaths, 1):
-            try:
-                logging.debug(f"   尝试导出类型 XPath {xpath_idx}/{len(export_type_xpaths)}")
-                target = WebDriverWait(driver, 5).until(
-                    EC.element_to_be_clickable((By.XPATH, xpath))
-                )
-                logging.info(f"✅ 找到导出类型选项（XPath {xpath_idx}）")
-                break
-            except TimeoutException:
-                continue
-        
-        if not target:
-            return None, "未找到导出类型选项"
-        
-        # 点击前记录文件列表
-        before_click_files = {p.name for p in Path(download_dir).iterdir() if p.is_file()}
-        logging.info(f"📊 点击前文件数: {len(before_click_files)}")
-        
-        target.click()
-        logging.info(f"✅ 导出类型已选择，开始下载...")
-        
-        # 点击后立即检查是否有弹窗
-        time.sleep(2)
+
+class DiagnosticsCollector:
+    """失败现场采集：按原因抽样，后台线程压缩写入有上限的调试目录"""
+
+    def __init__(self, directory=None, samples_per_reason=None, max_artifacts=None):
+        self.directory = directory or DEBUG_DIR
+        self.samples_per_reason = DEBUG_SAMPLES_PER_REASON if samples_per_reason is None else samples_per_reason
+        self.max_artifacts = max_artifacts or DEBUG_MAX_ARTIFACTS
+        self.index = []  # 已保存的调试文件
+        self.sampler = self.new_sampler()  # 批量运行使用的抽样状态
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def new_sampler(self):
+        return DiagnosticsSampler(self.samples_per_reason)
+
+    def capture(self, driver, prefix, reason, sampler=None):
+        """在调用线程取页面源码和截图（WebDriver 不能跨线程使用），压缩和写盘交给后台线程"""
+        reason = metric_reason(reason)
+        sampler = sampler or self.sampler
+        if not sampler.allow(reason):
+            METRICS.inc("qiwei_debug_artifacts_total", reason=reason, result="sampled_out")
+            return None
         
-        # 检查是否有确认按钮或其他弹窗
         try:
-            confirm_buttons = driver.find_elements(By.XPATH, 
-                "//button[contains(normalize-space(.),'确定') or "
-                "contains(normalize-space(.),'确认') or "
-                "contains(normalize-space(.),'下载')]"
-            )
-            if confirm_buttons:
-                logging.info(f"🔍 发现 {len(confirm_buttons)} 个确认按钮")
-                for btn in confirm_buttons:
-                    if btn.is_displayed():
-                        btn.click()
-                        logging.info(f"✅ 点击了确认按钮")
-                        time.sleep(1)
-                        break
+            url = driver.current_url
+            html = driver.page_source
+            png = driver.get_screenshot_as_png()
         except Exception as e:
-            logging.debug(f"检查确认按钮时出错: {e}")
+            logging.warning(f"⚠️  采集调试信息失败: {e}")
+            METRICS.inc("qiwei_debug_artifacts_total", reason=reason, result="error")
+            return None
         
-        # 再次记录文件列表用于比较
-        after_click_files = {p.name for p in Path(download_dir).iterdir() if p.is_file()}
-        new_immediate = after_click_files - before_click_files
-        if new_immediate:
-            logging.info(f"⚡ 点击后立即出现新文件: {list(new_immediate)}")
+        # 采集成功后才占用抽样名额
+        ts = datetime.now()
+        name = f"{ts.strftime('%Y%m%d_%H%M%S_%f')}_{safe_filename(prefix)[:80]}.zip"
+        path = os.path.join(self.directory, name)
+        sampler.taken(reason, path)
         
-        # 等待下载
-        downloaded = wait_for_new_download(before_files, download_dir, timeout=DOWNLOAD_TIMEOUT)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer, daemon=True)
+                self._thread.start()
+        self._queue.put((name, reason, prefix, url, ts, html, png))
+        return path
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self._write(*item)
+            except Exception as e:
+                logging.warning(f"⚠️  保存调试文件失败: {e}")
+                METRICS.inc("qiwei_debug_artifacts_total", reason=item[1], result="error")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, name, reason, prefix, url, ts, html, png):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        meta = {"reason": reason, "prefix": prefix, "url": url, "time": ts.strftime('%Y-%m-%d %H:%M:%S')}
         
-        return downloaded, "成功" if downloaded else "下载超时"
+        tmp_path = path + ".tmp"
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("page.html", html)
+            # PNG 本身已压缩，不再重复压缩
+            zf.writestr("screenshot.png", png, compress_type=zipfile.ZIP_STORED)
+            zf.writestr("meta.json", json.dumps(meta, ensure_ascii=False, indent=2))
+        os.replace(tmp_path, path)
         
-    except TimeoutException as e:
-        logging.warning(f"⚠️  等待页面元素超时: {e}")
-        return None, "元素超时"
-    except Exception as e:
-        logging.warning(f"⚠️  自动点击导出失败: {e}")
-        return None, f"点击失败: {str(e)}"
+        with self._lock:
+            self.index.append(dict(meta, path=path))
+            self.index = self.index[-self.max_artifacts:]
+        self._trim()
+        METRICS.inc("qiwei_debug_artifacts_total", reason=reason, result="saved")
+        logging.debug(f"💾 已保存调试文件：{path}")
 
+    def _trim(self):
+        """环形缓冲：只保留最新的 max_artifacts 份"""
+        artifacts = sorted(Path(self.directory).glob("*.zip"), key=lambda p: p.name)
+        for old in artifacts[:max(len(artifacts) - self.max_artifacts, 0)]:
+            try:
+                old.unlink()
+            except OSError:
+                pass
 
-def process_directory(directory_path, driver, dir_idx, total_dirs):
-    """处理单个目录 - 修复返回值问题"""
-    json_file = os.path.join(directory_path, "data.json")
-    
-    if not os.path.exists(json_file):
-        logging.warning(f"⚠️  目录 {directory_path} 中没有 data.json")
-        return 0, 0, 0, "无data.json文件"
+    def flush(self, timeout=30):
+        """等待后台写入完成（写运行报告前调用）"""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+
+    def report(self, samplers=None):
+        """运行报告中的调试文件索引；sampled_out 为给定抽样状态（默认批量运行）的合计"""
+        with self._lock:
+            existing = [a for a in self.index if os.path.exists(a["path"])]
+        dropped = {}
+        for sampler in samplers if samplers is not None else [self.sampler]:
+            with sampler._lock:
+                for reason, count in sampler.dropped.items():
+                    dropped[reason] = dropped.get(reason, 0) + count
+        return {
+            "directory": self.directory,
+            "sampled_out": dropped,
+            "artifacts": existing,
+        }
+
+
+DIAGNOSTICS = DiagnosticsCollector()
+
+
+def save_debug(driver, prefix, reason, sampler=None):
+    """保存调试信息（抽样、后台压缩写入 DEBUG_DIR）"""
+    path = DIAGNOSTICS.capture(driver, prefix, reason, sampler)
+    if path:
+        logging.info(f"💾 调试信息将保存到：{path}")
+    return path
+
+
+def find_existing_file(directory, filename, url):
+    """查找已下载的文件（包括带编号的版本），返回路径或 None"""
+    # 获取期望的文件扩展名
+    ext = guess_ext_from_url(url)
+    file_path = Path(directory) / f"{safe_filename(filename)}.{ext}"
+    if file_path.exists():
+        return file_path
     
-    dir_name = os.path.basename(directory_path)
-    logging.info(f"\n{'='*80}")
-    logging.info(f"📂 [{dir_idx}/{total_dirs}] 处理目录: {dir_name}")
-    logging.info(f"   路径: {directory_path}")
-    logging.info(f"{'='*80}")
+    # 检查是否有带编号的版本
+    alt_path = Path(directory) / f"{safe_filename(filename)}(1).{ext}"
+    if alt_path.exists():
+        return alt_path
     
-    # 读取 JSON
-    try:
-        with open(json_file, "r", encoding="utf-8") as f:
+    return None
+
+
+def check_file_exists(directory, filename, url, quiet=False):
+    """检查文件是否已存在"""
+    existing = find_existing_file(directory, filename, url)
+    if existing and not quiet:
+        logging.info(f"⏭️  文件已存在，跳过: {existing.name}")
+    return existing is not None
+
+
+# 导出菜单的 XPath（按文档类型），第一个不可用时依次尝试后面的
+EXPORT_XPATHS = {
+    "sheet": [
+        "//li[contains(@class,'mainmenu-submenu-exportAs') and contains(normalize-space(.),'导出')]",
+        "//li[contains(@class,'mainmenu-submenu') and contains(normalize-space(.),'导出')]",
+    ],
+    "doc": [
+        "//li[contains(@class,'mainmenu-submenu-export-as') and contains(normalize-space(.),'导出')]",
+        "//li[contains(@class,'mainmenu-submenu') and contains(normalize-space(.),'导出')]",
+    ],
+}
+EXPORT_TYPE_XPATHS = {
+    "sheet": [
+        "//li[contains(@class,'mainmenu-item-export-local') and contains(normalize-space(.),'本地')]",
+        "//li[contains(@class,'export-local') and contains(normalize-space(.),'本地')]",
+    ],
+    "doc": [
+        "//li[contains(@class,'mainmenu-item-export-as-docx') and contains(normalize-space(.),'本地')]",
+        "//li[contains(@class,'export-as-docx') and contains(normalize-space(.),'本地')]",
+    ],
+}
+CONFIRM_XPATH = (
+    "//button[contains(normalize-space(.),'确定') or "
+    "contains(normalize-space(.),'确认') or "
+    "contains(normalize-space(.),'下载')]"
+)
+
+# 在页面内一次完成 菜单 → 导出 → 本地 → 确认，用 MutationObserver 等待每一步的元素出现
+EXPORT_SCRIPT = """
+var menuId = arguments[0], exportXpaths = arguments[1], typeXpaths = arguments[2],
+    confirmXpath = arguments[3], menuTimeout = arguments[4], stepTimeout = arguments[5],
+    confirmTimeout = arguments[6], done = arguments[arguments.length - 1];
+
+function visible(el) {
+    if (!el || el.disabled) return false;
+    var rect = el.getBoundingClientRect(), style = window.getComputedStyle(el);
+    return rect.width > 0 && rect.height > 0 && style.visibility !== 'hidden' && style.display !== 'none';
+}
+function byXpath(xpath) {
+    try {
+        return document.evaluate(xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    } catch (e) {
+        return null;
+    }
+}
+function firstMatch(xpaths) {
+    for (var i = 0; i < xpaths.length; i++) {
+        var el = byXpath(xpaths[i]);
+        if (visible(el)) return {el: el, index: i};
+    }
+    return null;
+}
+function press(el) {
+    // 部分菜单只响应 pointer 事件，按真实点击的顺序同时发送 pointer 和 mouse 事件
+    var Pointer = window.PointerEvent || MouseEvent;
+    [['pointerover', Pointer], ['mouseover', MouseEvent], ['pointerdown', Pointer], ['mousedown', MouseEvent],
+     ['pointerup', Pointer], ['mouseup', MouseEvent], ['click', MouseEvent]].forEach(function (item) {
+        el.dispatchEvent(new item[1](item[0], {bubbles: true, cancelable: true, view: window, pointerType: 'mouse', isPrimary: true}));
+    });
+}
+function waitFor(find, timeout) {
+    return new Promise(function (resolve) {
+        var found = find();
+        if (found) return resolve(found);
+        var timer, observer = new MutationObserver(function () {
+            var match = find();
+            if (match) {
+                observer.disconnect();
+                clearTimeout(timer);
+                resolve(match);
+            }
+        });
+        observer.observe(document.documentElement, {childList: true, subtree: true, attributes: true});
+        timer = setTimeout(function () {
+            observer.disconnect();
+            resolve(find());
+        }, timeout);
+    });
+}
+
+var result = {stage: 'menu', export_index: -1, type_index: -1, confirmed: false};
+waitFor(function () {
+    var el = document.getElementById(menuId);
+    return visible(el) ? {el: el, index: 0} : null;
+}, menuTimeout).then(function (menu) {
+    if (!menu) throw 'menu';
+    press(menu.el);
+    result.stage = 'export';
+    return waitFor(function () { return firstMatch(exportXpaths); }, stepTimeout);
+}).then(function (exportItem) {
+    if (!exportItem) throw 'export';
+    result.export_index = exportItem.index;
+    press(exportItem.el);
+    result.stage = 'type';
+    return waitFor(function () { return firstMatch(typeXpaths); }, stepTimeout);
+}).then(function (typeItem) {
+    if (!typeItem) throw 'type';
+    result.type_index = typeItem.index;
+    press(typeItem.el);
+    result.stage = 'confirm';
+    return waitFor(function () {
+        var el = byXpath(confirmXpath);
+        return visible(el) ? {el: el, index: 0} : null;
+    }, confirmTimeout);
+}).then(function (confirm) {
+    if (confirm) {
+        press(confirm.el);
+        result.confirmed = true;
+    }
+    result.stage = 'done';
+    done(result);
+}).catch(function (e) {
+    result.error = String(e);
+    done(result);
+});
+"""
+
+# 脚本各阶段失败对应的状态
+EXPORT_SCRIPT_FAILURES = {
+    "menu": "元素超时",
+    "export": "未找到导出按钮",
+    "type": "未找到导出类型选项",
+}
+
+
+def doc_kind(url):
+    """根据 URL 判断文档类型：sheet / doc（不支持的链接在打开前已被跳过）"""
+    return "sheet" if "sheet" in str(url).lower() else "doc"
+
+
+class SelectorCache:
+    """记录每种文档类型上次成功的 XPath，下次优先尝试"""
+
+    def __init__(self):
+        self.path = None
+        self.data = {}  # kind -> {"export": xpath, "type": xpath}
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self.path is not None:
+            return
+        self.path = os.path.join(ROOT_DIRECTORY, SELECTOR_CACHE_FILE)
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.data = json.load(f)
+            except Exception as e:
+                logging.warning(f"⚠️  读取选择器缓存失败: {e}")
+
+    def ordered(self, kind, stage, xpaths):
+        """把上次成功的 XPath 排到最前面"""
+        with self._lock:
+            self._ensure_loaded()
+            cached = self.data.get(kind, {}).get(stage)
+        if cached in xpaths:
+            return [cached] + [x for x in xpaths if x != cached]
+        return list(xpaths)
+
+    def remember(self, kind, stage, xpath):
+        with self._lock:
+            self._ensure_loaded()
+            if self.data.get(kind, {}).get(stage) == xpath:
+                return
+            self.data.setdefault(kind, {})[stage] = xpath
+            # 临时文件以 . 开头，不会被 wait_for_new_download 当作新下载
+            tmp_path = os.path.join(os.path.dirname(self.path), f".{os.path.basename(self.path)}.tmp")
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logging.warning(f"⚠️  保存选择器缓存失败: {e}")
+
+
+SELECTOR_CACHE = SelectorCache()
+
+
+def run_export_script(driver, kind, export_xpaths, type_xpaths):
+    """注入脚本一次完成导出点击，返回 (状态, 结果)；脚本本身无法执行时状态为 None"""
+    try:
+        result = driver.execute_async_script(
+            EXPORT_SCRIPT, "main-menu-file", export_xpaths, type_xpaths, CONFIRM_XPATH,
+            WAIT_TIMEOUT * 1000, EXPORT_STEP_TIMEOUT * 1000, CONFIRM_WAIT * 1000,
+        )
+    except Exception as e:
+        logging.warning(f"⚠️  导出脚本执行失败，改用逐步点击: {e}")
+        return None, None
+    
+    if not isinstance(result, dict):
+        return None, None
+    if result.get("stage") != "done":
+        return EXPORT_SCRIPT_FAILURES.get(result.get("stage"), "点击失败"), result
+    
+    SELECTOR_CACHE.remember(kind, "export", export_xpaths[result["export_index"]])
+    SELECTOR_CACHE.remember(kind, "type", type_xpaths[result["type_index"]])
+    logging.info(f"✅ 导出脚本完成（导出 XPath {result['export_index'] + 1}，"
+                 f"类型 XPath {result['type_index'] + 1}"
+                 f"{'，已点击确认按钮' if result.get('confirmed') else ''}）")
+    return "成功", result
+
+
+def close_menus(driver):
+    """按 Esc 关闭导出脚本打开到一半的菜单"""
+    try:
+        driver.find_element(By.TAG_NAME, "body").send_keys(Keys.ESCAPE)
+        time.sleep(CLICK_WAIT)
+    except Exception as e:
+        logging.debug(f"关闭菜单时出错: {e}")
+
+
+def click_export_stepwise(driver, idx, total, kind, doc_type, export_xpaths, type_xpaths):
+    """逐步点击导出菜单（导出脚本不可用时的后备方案），返回失败状态或 None"""
+    # 1. 点击菜单
+    logging.info(f"🔍 [{idx}/{total}] 查找菜单按钮...")
+    menu = WebDriverWait(driver, WAIT_TIMEOUT).until(
+        EC.element_to_be_clickable((By.ID, "main-menu-file"))
+    )
+    menu.click()
+    logging.info(f"✅ 菜单按钮已点击")
+    time.sleep(MENU_WAIT)
+    
+    # 2. 点击导出
+    logging.info(f"🔍 查找导出按钮...")
+    export_li = None
+    for xpath_idx, xpath in enumerate(export_xpaths, 1):
+        try:
+            logging.debug(f"   尝试 XPath {xpath_idx}/{len(export_xpaths)}")
+            export_li = WebDriverWait(driver, EXPORT_STEP_TIMEOUT).until(
+                EC.element_to_be_clickable((By.XPATH, xpath))
+            )
+            logging.info(f"✅ 找到导出按钮（XPath {xpath_idx}）")
+            SELECTOR_CACHE.remember(kind, "export", xpath)
+            break
+        except TimeoutException:
+            continue
+    
+    if not export_li:
+        return "未找到导出按钮"
+    
+    export_li.click()
+    logging.info(f"✅ 导出按钮已点击")
+    time.sleep(CLICK_WAIT)
+    
+    # 3. 选择导出类型
+    logging.info(f"🔍 查找导出类型选项（{doc_type}）...")
+    target = None
+    for xpath_idx, xpath in enumerate(type_xpaths, 1):
+        try:
+            logging.debug(f"   尝试导出类型 XPath {xpath_idx}/{len(type_xpaths)}")
+            target = WebDriverWait(driver, EXPORT_STEP_TIMEOUT).until(
+                EC.element_to_be_clickable((By.XPATH, xpath))
+            )
+            logging.info(f"✅ 找到导出类型选项（XPath {xpath_idx}）")
+            SELECTOR_CACHE.remember(kind, "type", xpath)
+            break
+        except TimeoutException:
+            continue
+    
+    if not target:
+        return "未找到导出类型选项"
+    
+    target.click()
+    logging.info(f"✅ 导出类型已选择，开始下载...")
+    
+    # 点击后立即检查是否有弹窗
+    time.sleep(CONFIRM_WAIT)
+    
+    # 检查是否有确认按钮或其他弹窗
+    try:
+        confirm_buttons = driver.find_elements(By.XPATH, CONFIRM_XPATH)
+        if confirm_buttons:
+            logging.info(f"🔍 发现 {len(confirm_buttons)} 个确认按钮")
+            for btn in confirm_buttons:
+                if btn.is_displayed():
+                    btn.click()
+                    logging.info(f"✅ 点击了确认按钮")
+                    time.sleep(1)
+                    break
+    except Exception as e:
+        logging.debug(f"检查确认按钮时出错: {e}")
+    
+    return None
+
+
+def click_export_and_download(driver, name, url, idx, total, download_dir, before_files):
+    """点击导出并下载 - 改进版本"""
+    
+    kind = doc_kind(url)
+    doc_type = "表格" if kind == "sheet" else "文档"
+    export_xpaths = SELECTOR_CACHE.ordered(kind, "export", EXPORT_XPATHS[kind])
+    type_xpaths = SELECTOR_CACHE.ordered(kind, "type", EXPORT_TYPE_XPATHS[kind])
+    
+    ui_start = time.time()
+    try:
+        # 点击前记录文件列表
+        before_click_files = {p.name for p in Path(download_dir).iterdir() if p.is_file()}
+        logging.info(f"📊 点击前文件数: {len(before_click_files)}")
+        
+        scripted = False
+        if SCRIPTED_EXPORT:
+            logging.info(f"⚡ [{idx}/{total}] 执行导出脚本（{doc_type}）...")
+            status, _ = run_export_script(driver, kind, export_xpaths, type_xpaths)
+            scripted = status == "成功"
+            if status is not None and not scripted:
+                # 脚本发送的是合成事件，部分菜单不响应：关闭已打开的菜单后用 WebDriver 真实点击重试
+                logging.warning(f"⚠️  导出脚本未完成（{status}），改用逐步点击")
+                close_menus(driver)
+        
+        if not scripted:
+            status = click_export_stepwise(
+                driver, idx, total, kind, doc_type, export_xpaths, type_xpaths
+            )
+            if status:
+                return None, status
+        
+        # 再次记录文件列表用于比较
+        after_click_files = {p.name for p in Path(download_dir).iterdir() if p.is_file()}
+        new_immediate = after_click_files - before_click_files
+        if new_immediate:
+            logging.info(f"⚡ 点击后立即出现新文件: {list(new_immediate)}")
+        
+        METRICS.observe("qiwei_phase_duration_seconds", time.time() - ui_start, phase="export")
+        
+        # 等待下载
+        download_start = time.time()
+        downloaded = wait_for_new_download(before_files, download_dir, timeout=DOWNLOAD_TIMEOUT)
+        METRICS.observe("qiwei_phase_duration_seconds", time.time() - download_start, phase="download")
+        
+        return downloaded, "成功" if downloaded else "下载超时"
+        
+    except TimeoutException as e:
+        logging.warning(f"⚠️  等待页面元素超时: {e}")
+        return None, "元素超时"
+    except Exception as e:
+        logging.warning(f"⚠️  自动点击导出失败: {e}")
+        return None, f"点击失败: {str(e)}"
+
+
+def find_data_directories(root=None):
+    """查找所有包含 data.json 的目录，按路径深度排序"""
+    root = root or ROOT_DIRECTORY
+    directories = []
+    logging.info("🔍 正在扫描目录...")
+    for dirpath, dirs, files in os.walk(root):
+        if "data.json" in files:
+            directories.append(dirpath)
+            logging.info(f"   ✓ 找到: {os.path.relpath(dirpath, root)}")
+    
+    # 按路径深度排序，确保先处理父目录
+    directories.sort(key=lambda x: x.count(os.sep))
+    return directories
+
+
+def load_file_list(directory_path):
+    """读取目录下 data.json 的 file_list，返回 (列表, 错误状态)"""
+    json_file = os.path.join(directory_path, "data.json")
+    
+    if not os.path.exists(json_file):
+        logging.warning(f"⚠️  目录 {directory_path} 中没有 data.json")
+        return None, "无data.json文件"
+    
+    try:
+        with open(json_file, "r", encoding="utf-8") as f:
             data = json.load(f)
     except Exception as e:
         logging.error(f"❌ 无法读取 JSON 文件 {json_file}: {e}")
-        return 0, 0, 0, "JSON读取失败"
+        return None, "JSON读取失败"
     
     infos = data.get("body", {}).get("file_list", [])
     if not infos:
         logging.warning("⚠️  JSON 中未找到 file_list，跳过此目录")
-        return 0, 0, 0, "无file_list数据"
+        return None, "无file_list数据"
+    
+    return infos, None
+
+
+def collect_pending(directories, history=None):
+    """收集所有尚未下载的文档，返回 {目录: [doc_url, ...]}"""
+    pending = {}
+    for directory in directories:
+        infos, _ = load_file_list(directory)
+        urls = []
+        for idx, info in enumerate(infos or [], start=1):
+            url = info.get("doc_url")
+            name = safe_filename(info.get("name", f"doc_{idx}"))
+            if not url or (history and history.permanent_failure(url)):
+                continue
+            if not check_file_exists(directory, name, url, quiet=True):
+                urls.append(url)
+        pending[directory] = urls
+    return pending
+
+
+def schedule_documents(infos, history, strategy=None, defer_flaky=None):
+    """根据历史耗时、大小和失败率重排 file_list，返回 [(原序号, info), ...]
+
+    原序号从 1 开始，用于生成没有 name 的文档的默认文件名 doc_<序号>，不受排序影响。
+    """
+    strategy = strategy or SCHEDULE_STRATEGY
+    defer_flaky = DEFER_FLAKY if defer_flaky is None else defer_flaky
+    entries = list(enumerate(infos, start=1))
+    if strategy == "listed" and not defer_flaky:
+        return entries
+    type_averages = history.type_averages()
+    
+    def sort_key(entry):
+        info = entry[1]
+        url = info.get("doc_url") or ""
+        flaky = defer_flaky and bool(url) and history.is_flaky(url)
+        if strategy == "listed" or not url:
+            return (flaky, 0, 0)
+        estimate = history.estimate(url, type_averages)
+        size = (history.get(url) or {}).get("size", 0)
+        if strategy == "longest":
+            return (flaky, -estimate, -size)
+        return (flaky, estimate, size)
+    
+    # sorted 是稳定排序，相同预估的文档保持原有顺序
+    return sorted(entries, key=sort_key)
+
+
+def schedule_directories(directories, pending, history, strategy=None):
+    """按待处理文档的预估总耗时排序目录，"listed" 时保持按路径深度的顺序"""
+    strategy = strategy or SCHEDULE_STRATEGY
+    if strategy not in ("shortest", "longest"):
+        return list(directories)
+    
+    type_averages = history.type_averages()
+    totals = {
+        directory: sum(history.estimate(url, type_averages) for url in pending.get(directory, []))
+        for directory in directories
+    }
+    return sorted(directories, key=lambda d: totals[d], reverse=(strategy == "longest"))
+
+
+def plan_run():
+    """预估模式：根据耗时历史预估待处理文档的总运行时间"""
+    logging.info("=" * 80)
+    logging.info("🧮 运行时间预估（不启动浏览器）")
+    logging.info("=" * 80)
+    
+    if not os.path.exists(ROOT_DIRECTORY):
+        logging.error(f"❌ 根目录不存在: {ROOT_DIRECTORY}")
+        return
+    
+    directories = find_data_directories()
+    if not directories:
+        logging.warning("⚠️  未找到包含data.json的目录")
+        return
+    
+    history = TimingHistory(os.path.join(ROOT_DIRECTORY, TIMING_HISTORY_FILE))
+    pending = collect_pending(directories, history)
+    estimates, overhead = history.plan(pending)
+    
+    for ext, avg in history.type_averages().items():
+        if avg is not None:
+            logging.info(f"   📐 {ext} 平均耗时: {avg:.1f}秒")
+    
+    logging.info(f"\n{'目录':<40} {'待处理':>8} {'有历史':>8} {'预估耗时':>12}")
+    logging.info("-" * 80)
+    
+    total_docs = 0
+    total_known = 0
+    total_seconds = 0.0
+    for directory in directories:
+        urls = pending[directory]
+        if not urls:
+            continue
+        known = sum(1 for url in urls if history.get(url))
+        seconds = sum(estimates[url] for url in urls)
+        total_docs += len(urls)
+        total_known += known
+        total_seconds += seconds
+        
+        dir_name = os.path.relpath(directory, ROOT_DIRECTORY)
+        if len(dir_name) > 38:
+            dir_name = "..." + dir_name[-35:]
+        logging.info(f"{dir_name:<40} {len(urls):>8} {known:>8} {format_time(seconds):>12}")
+    
+    total_seconds += overhead
+    
+    logging.info("=" * 80)
+    logging.info(f"📄 待处理文档: {total_docs}（其中 {total_known} 个有历史耗时）")
+    logging.info(f"⏱️  预估总耗时: {format_time(total_seconds)}")
+    logging.info("=" * 80)
+
+
+def download_document(driver, name, url, idx, total, download_dir, session=None, sampler=None):
+    """打开并导出单个文档，返回 (保存路径, 状态)"""
+    if is_unsupported_url(url):
+        logging.warning(f"❌ 不是可导出的文档或表格链接，跳过")
+        return None, PAGE_CLASS_FAILURES["unsupported"]
+    
+    if session:
+        session.wait_ready()
+    
+    # 打开页面
+    open_start = time.time()
+    try:
+        logging.info(f"🌐 打开页面...")
+        if CLASSIFY_PAGES:
+            drain_network_log(driver)  # 丢弃上一个文档的网络事件
+        driver.get(url)
+        if session and not session.after_navigation(driver, url):
+            return None, SESSION_EXPIRED_STATUS
+        
+        if CLASSIFY_PAGES:
+            page_class = classify_page(driver, session)
+            if page_class == "login":
+                # 延迟跳转到登录页：交给登录检测处理，恢复后重新分类一次
+                if not session or not session.after_navigation(driver, url):
+                    return None, SESSION_EXPIRED_STATUS
+                page_class = classify_page(driver, session)
+                if page_class == "login":
+                    return None, SESSION_EXPIRED_STATUS
+            if page_class in PAGE_CLASS_FAILURES:
+                logging.warning(f"❌ {PAGE_CLASS_FAILURES[page_class]}，不再重试")
+                return None, PAGE_CLASS_FAILURES[page_class]
+        else:
+            time.sleep(PAGE_STABLE_WAIT)
+        logging.info(f"✅ 页面加载完成")
+        
+    except Exception as e:
+        logging.warning(f"❌ 打开页面异常: {e}")
+        save_debug(driver, f"{idx}_{name}_open_err", "打开失败", sampler)
+        return None, "打开失败"
+    finally:
+        METRICS.observe("qiwei_phase_duration_seconds", time.time() - open_start, phase="open")
+    
+    # 在点击下载前记录文件列表
+    before_files = {p.name for p in Path(download_dir).iterdir() if p.is_file()}
+    
+    # 点击导出并下载
+    METRICS.add("qiwei_exports_in_flight", 1)
+    try:
+        downloaded, status = click_export_and_download(
+            driver, name, url, idx, total, download_dir, before_files
+        )
+    finally:
+        METRICS.add("qiwei_exports_in_flight", -1)
+    
+    if not downloaded:
+        logging.warning(f"❌ 下载失败: {status}")
+        save_debug(driver, f"{idx}_{name}_{status}", status, sampler)
+        return None, status
+    
+    # 重命名文件
+    src = Path(downloaded)
+    ext = src.suffix if src.suffix else f".{guess_ext_from_url(url)}"
+    
+    # 目标文件名（不带后缀）
+    dest = Path(download_dir) / f"{name}{ext}"
+    
+    # 如果下载的文件已经是正确的名字，就不需要重命名
+    if src != dest:
+        # 需要重命名，检查目标文件是否存在
+        if dest.exists():
+            i = 1
+            while True:
+                alt = Path(download_dir) / f"{name}({i}){ext}"
+                if not alt.exists():
+                    dest = alt
+                    break
+                i += 1
+        
+        try:
+            shutil.move(str(src), str(dest))
+        except Exception as e:
+            logging.warning(f"❌ 重命名失败: {e}")
+            return None, "重命名失败"
     
-    logging.info(f"📊 本目录共有 {len(infos)} 个文档待处理")
+    file_size_mb = dest.stat().st_size / (1024 * 1024)
+    logging.info(f"✅ 下载完成: {dest.name} ({file_size_mb:.2f} MB)")
+    
+    # 记录到下载日志
+    rel_path = os.path.relpath(str(dest), ROOT_DIRECTORY)
+    log_downloaded_file(rel_path, dest.name)
+    
+    return str(dest), "成功"
+
+
+def record_document_result(url, dest, status, duration, history=None, tracker=None):
+    """记录单个文档的处理结果到历史、进度和指标，返回文件大小"""
+    size = os.path.getsize(dest) if dest else None
+    # 登录失效与文档本身无关，不计入该文档的失败历史
+    if history and status != SESSION_EXPIRED_STATUS:
+        history.record(url, duration, bool(dest), status, size)
+    if tracker:
+        tracker.complete(url, duration)
+    
+    if dest:
+        METRICS.inc("qiwei_documents_total", result="success", reason="成功")
+        METRICS.inc("qiwei_downloaded_bytes_total", size)
+    else:
+        METRICS.inc("qiwei_documents_total", result="failed", reason=metric_reason(status))
+    return size
+
+
+def process_directory(directory_path, driver, dir_idx, total_dirs, history=None, tracker=None, session=None,
+                      deferred=None, entries=None):
+    """处理单个目录 - 修复返回值问题
+
+    deferred 为列表时，不稳定的文档不在本目录处理，而是以 (原序号, info) 追加到其中，
+    由调用方在所有目录之后通过 entries 参数再处理。
+    """
+    dir_name = os.path.basename(directory_path)
+    logging.info(f"\n{'='*80}")
+    logging.info(f"📂 [{dir_idx}/{total_dirs}] 处理目录: {dir_name}" + ("（延后的文档）" if entries else ""))
+    logging.info(f"   路径: {directory_path}")
+    logging.info(f"{'='*80}")
+    
+    rel_dir = os.path.relpath(directory_path, ROOT_DIRECTORY)
+    if entries is None:
+        infos, error_status = load_file_list(directory_path)
+        if error_status:
+            return 0, 0, 0, error_status
+        
+        logging.info(f"📊 本目录共有 {len(infos)} 个文档待处理")
+        
+        entries = schedule_documents(infos, history) if history else list(enumerate(infos, start=1))
+        METRICS.set("qiwei_directory_documents", len(entries), directory=rel_dir, state="total")
+        METRICS.set("qiwei_directory_documents", 0, directory=rel_dir, state="done")
     
     # 更新下载目录为当前目录
     download_dir = directory_path
@@ -541,107 +1829,76 @@ def process_directory(directory_path, driver, dir_idx, total_dirs):
     failed_count = 0
     skipped_count = 0
     failed_details = []
+    session_expired = False
     
     start_time = time.time()
     
-    for idx, info in enumerate(infos, start=1):
-        name_raw = info.get("name", f"doc_{idx}")
+    for idx, (orig_idx, info) in enumerate(entries, start=1):
+        name_raw = info.get("name", f"doc_{orig_idx}")
         name = safe_filename(name_raw)
         url = info.get("doc_url")
         
         # 显示进度
         logging.info(f"\n{'─'*80}")
-        print_progress_bar(idx - 1, len(infos), prefix=f'📈 目录进度')
-        logging.info(f"📄 [{idx}/{len(infos)}] 正在处理: {name}")
-        logging.info(f"   URL: {url[:80]}..." if len(url) > 80 else f"   URL: {url}")
+        print_progress_bar(idx - 1, len(entries), prefix=f'📈 目录进度',
+                           suffix=tracker.summary() if tracker else '')
+        logging.info(f"📄 [{idx}/{len(entries)}] 正在处理: {name}")
+        if url:
+            logging.info(f"   URL: {url[:80]}..." if len(url) > 80 else f"   URL: {url}")
         
         if not url:
             logging.warning(f"⚠️  未提供 doc_url，跳过")
             failed_count += 1
             failed_details.append((name, "无URL"))
+            METRICS.inc("qiwei_documents_total", result="failed", reason="无URL")
+            METRICS.add("qiwei_directory_documents", 1, directory=rel_dir, state="done")
             continue
         
         # 检查文件是否已存在
         if check_file_exists(download_dir, name, url):
             skipped_count += 1
+            METRICS.inc("qiwei_documents_total", result="skipped", reason="已存在")
+            METRICS.add("qiwei_directory_documents", 1, directory=rel_dir, state="done")
             continue
         
-        # 打开页面
-        try:
-            logging.info(f"🌐 打开页面...")
-            driver.get(url)
-            time.sleep(PAGE_STABLE_WAIT)
-            logging.info(f"✅ 页面加载完成")
-            
-        except Exception as e:
-            logging.warning(f"❌ 打开页面异常: {e}")
-            save_debug(driver, f"{idx}_{name}_open_err", download_dir)
+        # 之前已判定为不存在 / 无权限 / 不支持的文档不再打开
+        permanent = history.permanent_failure(url) if history else None
+        if permanent:
+            logging.info(f"⏭️  {permanent}（历史记录），不再重试")
             failed_count += 1
-            failed_details.append((name, "打开失败"))
+            failed_details.append((name, permanent))
+            METRICS.inc("qiwei_documents_total", result="failed", reason=permanent)
+            METRICS.add("qiwei_directory_documents", 1, directory=rel_dir, state="done")
             continue
         
-        # 在点击下载前记录文件列表
-        before_files = {p.name for p in Path(download_dir).iterdir() if p.is_file()}
-        
-        # 点击导出并下载
-        downloaded, status = click_export_and_download(
-            driver, name, url, idx, len(infos), download_dir, before_files
-        )
-        
-        if not downloaded:
-            logging.warning(f"❌ 下载失败: {status}")
-            save_debug(driver, f"{idx}_{name}_{status}", download_dir)
-            failed_count += 1
-            failed_details.append((name, status))
+        # 经常失败的文档推迟到所有目录处理完之后
+        if deferred is not None and history and history.is_flaky(url):
+            logging.info(f"⏭️  历史上经常失败，推迟到最后处理")
+            deferred.append((orig_idx, info))
             continue
         
-        # 重命名文件
-        src = Path(downloaded)
-        ext = src.suffix if src.suffix else f".{guess_ext_from_url(url)}"
-        
-        # 目标文件名（不带后缀）
-        dest = Path(download_dir) / f"{name}{ext}"
+        doc_start = time.time()
+        dest, status = download_document(driver, name, url, idx, len(entries), download_dir, session)
+        record_document_result(url, dest, status, time.time() - doc_start, history, tracker)
+        METRICS.add("qiwei_directory_documents", 1, directory=rel_dir, state="done")
         
-        # 如果下载的文件已经是正确的名字，就不需要重命名
-        if src == dest:
-            file_size_mb = dest.stat().st_size / (1024 * 1024)
-            logging.info(f"✅ 下载完成: {dest.name} ({file_size_mb:.2f} MB)")
-            
-            # 记录到下载日志
-            rel_path = os.path.relpath(str(dest), ROOT_DIRECTORY)
-            log_downloaded_file(rel_path, dest.name)
-            
+        if dest:
             success_count += 1
         else:
-            # 需要重命名，检查目标文件是否存在
-            if dest.exists():
-                i = 1
-                while True:
-                    alt = Path(download_dir) / f"{name}({i}){ext}"
-                    if not alt.exists():
-                        dest = alt
-                        break
-                    i += 1
-            
-            try:
-                shutil.move(str(src), str(dest))
-                file_size_mb = dest.stat().st_size / (1024 * 1024)
-                logging.info(f"✅ 下载完成: {dest.name} ({file_size_mb:.2f} MB)")
-                
-                # 记录到下载日志
-                rel_path = os.path.relpath(str(dest), ROOT_DIRECTORY)
-                log_downloaded_file(rel_path, dest.name)
-                
-                success_count += 1
-            except Exception as e:
-                logging.warning(f"❌ 重命名失败: {e}")
-                failed_count += 1
-                failed_details.append((name, "重命名失败"))
-                continue
+            failed_count += 1
+            failed_details.append((name, status))
+        
+        if status == SESSION_EXPIRED_STATUS or (session and not session.record(driver, bool(dest))):
+            logging.error("🔐 登录已失效且无法恢复，停止处理")
+            session_expired = True
+            break
         
         # 简单的间隔
-        if idx < len(infos):
-            time.sleep(2)
+        if dest and idx < len(entries):
+            time.sleep(DOC_INTERVAL_WAIT)
+    
+    if history:
+        history.save()
     
     # 计算耗时
     elapsed_time = time.time() - start_time
@@ -660,7 +1917,529 @@ def process_directory(directory_path, driver, dir_idx, total_dirs):
         for name, reason in failed_details:
             logging.info(f"  ❌ {name}: {reason}")
     
-    return success_count, failed_count, skipped_count, "完成"
+    return success_count, failed_count, skipped_count, SESSION_EXPIRED_STATUS if session_expired else "完成"
+
+
+class DownloadJob:
+    """守护进程中的一个下载任务"""
+
+    def __init__(self, items, source, callback=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.items = items  # [{"name", "doc_url", "target"}, ...]
+        self.source = source
+        self.callback = callback  # 任务结束后调用 callback(job)
+        self.diagnostics = DIAGNOSTICS.new_sampler()  # 每个任务单独抽样
+        self.status = "queued"
+        self.error = None
+        self.results = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self, with_results=True):
+        data = {
+            "id": self.id,
+            "source": self.source,
+            "status": self.status,
+            "error": self.error,
+            "total": len(self.items),
+            "processed": len(self.results),
+            "success": sum(1 for r in self.results if r["status"] == "success"),
+            "skipped": sum(1 for r in self.results if r["status"] == "skipped"),
+            "failed": sum(1 for r in self.results if r["status"] == "failed"),
+            "created": datetime.fromtimestamp(self.created).strftime('%Y-%m-%d %H:%M:%S'),
+            "started": datetime.fromtimestamp(self.started).strftime('%Y-%m-%d %H:%M:%S') if self.started else None,
+            "finished": datetime.fromtimestamp(self.finished).strftime('%Y-%m-%d %H:%M:%S') if self.finished else None,
+        }
+        if with_results:
+            data["results"] = list(self.results)
+        return data
+
+
+class DownloadService:
+    """常驻浏览器的下载服务：任务队列 + 多个 worker，每个 worker 持有一个已登录的浏览器"""
+
+    def __init__(self, workers=DAEMON_WORKERS):
+        if USE_REAL_PROFILE and workers > 1:
+            logging.warning("⚠️  真实浏览器 Profile 不能被多个浏览器同时使用，worker 数改为 1")
+            workers = 1
+        self.worker_count = max(workers, 1)
+        self.history = TimingHistory(os.path.join(ROOT_DIRECTORY, TIMING_HISTORY_FILE))
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.drivers = []
+        self._jobs_lock = threading.Lock()
+        self._dir_locks = {}
+        self._stopping = threading.Event()
+        self.session_gate = SessionGate()
+        self.guards = []
+
+    @staticmethod
+    def _resolve(path):
+        """解析任务中的路径，只允许位于 ROOT_DIRECTORY 之内"""
+        path = os.path.expanduser(str(path))
+        if not os.path.isabs(path):
+            path = os.path.join(ROOT_DIRECTORY, path)
+        path = os.path.realpath(path)
+        root = os.path.realpath(ROOT_DIRECTORY)
+        if os.path.commonpath([path, root]) != root:
+            raise ValueError(f"路径不在根目录内: {path}")
+        return path
+
+    def submit(self, payload):
+        """提交任务：{"directory": 路径} 或 {"items": [{"name", "doc_url", "target"}]}"""
+        if not isinstance(payload, dict):
+            raise ValueError("请求体必须是 JSON 对象")
+        
+        if payload.get("directory"):
+            directory = self._resolve(payload["directory"])
+            infos, error_status = load_file_list(directory)
+            if error_status:
+                raise ValueError(f"{directory}: {error_status}")
+            items = [{
+                "name": info.get("name", f"doc_{idx}"),
+                "doc_url": info.get("doc_url"),
+                "target": directory,
+            } for idx, info in schedule_documents(infos, self.history)]
+            source = os.path.relpath(directory, ROOT_DIRECTORY)
+        elif isinstance(payload.get("items"), list):
+            items = []
+            for idx, item in enumerate(payload["items"], start=1):
+                if not isinstance(item, dict) or not item.get("doc_url"):
+                    raise ValueError(f"第 {idx} 项缺少 doc_url")
+                items.append({
+                    "name": item.get("name", f"doc_{idx}"),
+                    "doc_url": item["doc_url"],
+                    "target": self._resolve(item.get("target") or ROOT_DIRECTORY),
+                })
+            source = payload.get("source", "items")
+        else:
+            raise ValueError("需要提供 directory 或 items")
+        
+        if not items:
+            raise ValueError("任务中没有文档")
+        return self.enqueue(items, source)
+
+    def enqueue(self, items, source, callback=None):
+        job = DownloadJob(items, source, callback)
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+            # 只淘汰已结束的旧任务
+            finished = [j for j in self.jobs.values() if j.status in ("done", "failed")]
+            for old in sorted(finished, key=lambda j: j.created)[:max(len(self.jobs) - DAEMON_MAX_JOBS, 0)]:
+                del self.jobs[old.id]
+        self.queue.put(job)
+        METRICS.add("qiwei_daemon_jobs", 1, status="queued")
+        logging.info(f"📥 收到任务 {job.id}（{source}，{len(items)} 个文档）")
+        return job
+
+    def get(self, job_id):
+        with self._jobs_lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self._jobs_lock:
+            return sorted(self.jobs.values(), key=lambda j: j.created, reverse=True)
+
+    def _dir_lock(self, directory):
+        # 同一个目录同时只能有一个浏览器下载，否则无法区分新文件属于哪个文档
+        with self._jobs_lock:
+            return self._dir_locks.setdefault(directory, threading.Lock())
+
+    def start(self):
+        # 依次启动浏览器，避免并发修补 chromedriver
+        for i in range(self.worker_count):
+            logging.info(f"🌐 正在启动第 {i + 1}/{self.worker_count} 个常驻浏览器...")
+            self.drivers.append(start_browser_session(interactive=False))
+            self.guards.append(SessionGuard(self.session_gate))
+        for i in range(self.worker_count):
+            threading.Thread(target=self._worker, args=(i,), daemon=True).start()
+
+    def stop(self):
+        self._stopping.set()
+        for driver in self.drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+        self.history.save()
+        logging.info("🔒 常驻浏览器已关闭")
+
+    def _ensure_driver(self, worker_idx):
+        """浏览器失去响应时重新启动"""
+        driver = self.drivers[worker_idx]
+        try:
+            driver.current_url
+            return driver
+        except Exception as e:
+            logging.warning(f"⚠️  浏览器 {worker_idx + 1} 无响应，正在重启: {e}")
+            try:
+                driver.quit()
+            except Exception:
+                pass
+            self.drivers[worker_idx] = start_browser_session(interactive=False)
+            return self.drivers[worker_idx]
+
+    def _worker(self, worker_idx):
+        while not self._stopping.is_set():
+            try:
+                job = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            
+            METRICS.add("qiwei_daemon_jobs", -1, status="queued")
+            METRICS.add("qiwei_daemon_jobs", 1, status="running")
+            job.status = "running"
+            job.started = time.time()
+            try:
+                self._run_job(self._ensure_driver(worker_idx), job, self.guards[worker_idx])
+                job.status = "failed" if job.error else "done"
+            except Exception as e:
+                logging.error(f"❌ 任务 {job.id} 异常: {e}")
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                job.finished = time.time()
+                METRICS.add("qiwei_daemon_jobs", -1, status="running")
+                METRICS.inc("qiwei_daemon_jobs_finished_total", status=job.status)
+                self.history.save()
+                if job.callback:
+                    try:
+                        job.callback(job)
+                    except Exception as e:
+                        logging.warning(f"⚠️  任务 {job.id} 回调失败: {e}")
+                self.queue.task_done()
+                logging.info(f"📤 任务 {job.id} 结束: {job.status}")
+
+    def _run_job(self, driver, job, session=None):
+        current_dir = None
+        total = len(job.items)
+        for idx, item in enumerate(job.items, start=1):
+            name = safe_filename(item["name"])
+            url = item["doc_url"]
+            target = item["target"]
+            result = {"name": name, "doc_url": url, "target": target}
+            
+            if not url:
+                job.results.append(dict(result, status="failed", reason="无URL", path=None))
+                METRICS.inc("qiwei_documents_total", result="failed", reason="无URL")
+                continue
+            
+            os.makedirs(target, exist_ok=True)
+            existing = find_existing_file(target, name, url)
+            if existing:
+                job.results.append(dict(result, status="skipped", reason="已存在", path=str(existing)))
+                METRICS.inc("qiwei_documents_total", result="skipped", reason="已存在")
+                continue
+            
+            permanent = self.history.permanent_failure(url)
+            if permanent:
+                job.results.append(dict(result, status="failed", reason=permanent, path=None))
+                METRICS.inc("qiwei_documents_total", result="failed", reason=permanent)
+                continue
+            
+            with self._dir_lock(target):
+                if target != current_dir:
+                    update_download_directory(driver, target)
+                    current_dir = target
+                logging.info(f"📄 [{job.id} {idx}/{total}] 正在处理: {name}")
+                doc_start = time.time()
+                captured = len(job.diagnostics.artifacts)
+                dest, status = download_document(driver, name, url, idx, total, target, session,
+                                                 job.diagnostics)
+                duration = time.time() - doc_start
+            
+            record_document_result(url, dest, status, duration, self.history)
+            job.results.append(dict(
+                result,
+                status="success" if dest else "failed",
+                reason=status,
+                path=dest,
+                duration=round(duration, 2),
+                debug=job.diagnostics.artifacts[captured:],
+            ))
+            
+            if status == SESSION_EXPIRED_STATUS or (session and not session.record(driver, bool(dest))):
+                job.error = "登录已失效且重新认证失败，任务中止"
+                logging.error(f"🔐 任务 {job.id}: {job.error}")
+                return
+
+
+class _DataJsonEventHandler(FileSystemEventHandler):
+    """把 data.json 的创建/修改/移动事件转给 DataJsonWatcher"""
+
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def _notify(self, path):
+        if os.path.basename(path) == "data.json":
+            self.watcher.mark_dirty(path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._notify(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._notify(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._notify(event.dest_path)
+
+
+class DataJsonWatcher:
+    """监控根目录下的 data.json，只把新增或变更的文档加入下载队列"""
+
+    def __init__(self, service, root=None):
+        self.service = service
+        self.root = root or ROOT_DIRECTORY
+        self.state_path = os.path.join(self.root, WATCH_STATE_FILE)
+        self.state = {}  # 目录相对路径 -> {doc_url: name}（已成功处理的文档）
+        self.inflight = {}  # (目录相对路径, doc_url) -> 入队时的 name
+        self._stale = set()  # 有文档在处理中被改名的目录，任务结束后需要重新比对
+        self._dirty = {}  # data.json 路径 -> 最近一次变化时间
+        self._mtimes = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._observer = None
+        self._load_state()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        except Exception as e:
+            logging.warning(f"⚠️  读取监控状态失败: {e}")
+
+    def _save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        try:
+            with self._lock:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.state, f, ensure_ascii=False)
+                os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            logging.warning(f"⚠️  保存监控状态失败: {e}")
+
+    def start(self):
+        # 启动时先处理一遍已有的 data.json，补上离线期间的变化
+        for directory in find_data_directories(self.root):
+            json_path = os.path.join(directory, "data.json")
+            self._mtimes[json_path] = self._stat(json_path)
+            self.process(json_path)
+        
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_DataJsonEventHandler(self), self.root, recursive=True)
+            self._observer.start()
+            logging.info(f"👀 正在监控 data.json 变化（watchdog）: {self.root}")
+        else:
+            threading.Thread(target=self._poll_loop, daemon=True).start()
+            logging.info(f"👀 未安装 watchdog，每 {WATCH_POLL_INTERVAL} 秒轮询 data.json: {self.root}")
+        threading.Thread(target=self._debounce_loop, daemon=True).start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=5)
+        self._save_state()
+
+    def mark_dirty(self, path, delay=0):
+        """标记 data.json 需要重新解析；delay 秒内不处理"""
+        with self._lock:
+            self._dirty[os.path.abspath(path)] = time.time() + delay
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_mtime, st.st_size
+        except OSError:
+            return None
+
+    def _poll_loop(self):
+        while not self._stopping.wait(WATCH_POLL_INTERVAL):
+            for dirpath, dirs, files in os.walk(self.root):
+                if "data.json" not in files:
+                    continue
+                json_path = os.path.join(dirpath, "data.json")
+                stat = self._stat(json_path)
+                if stat and stat != self._mtimes.get(json_path):
+                    self._mtimes[json_path] = stat
+                    self.mark_dirty(json_path)
+
+    def _debounce_loop(self):
+        while not self._stopping.wait(0.5):
+            now = time.time()
+            with self._lock:
+                ready = [p for p, t in self._dirty.items() if now - t >= WATCH_DEBOUNCE]
+                for p in ready:
+                    del self._dirty[p]
+            for json_path in ready:
+                try:
+                    self.process(json_path)
+                except Exception as e:
+                    logging.warning(f"⚠️  处理 {json_path} 失败: {e}")
+
+    def process(self, json_path):
+        """解析单个 data.json，把未处理过或名称变化的文档加入队列"""
+        directory = os.path.dirname(os.path.abspath(json_path))
+        infos, error_status = load_file_list(directory)
+        if error_status:
+            return None
+        
+        rel_dir = os.path.relpath(directory, self.root)
+        items = []
+        with self._lock:
+            known = self.state.get(rel_dir, {})
+            for idx, info in schedule_documents(infos, self.service.history):
+                url = info.get("doc_url")
+                name = info.get("name", f"doc_{idx}")
+                if not url or known.get(url) == name:
+                    continue
+                if (rel_dir, url) in self.inflight:
+                    if self.inflight[(rel_dir, url)] != name:
+                        self._stale.add(rel_dir)
+                    continue
+                self.inflight[(rel_dir, url)] = name
+                items.append({"name": name, "doc_url": url, "target": directory})
+        
+        if not items:
+            logging.debug(f"{rel_dir}/data.json 没有新文档")
+            return None
+        
+        logging.info(f"🆕 {rel_dir}/data.json 中有 {len(items)} 个新增或变更的文档")
+        return self.service.enqueue(items, f"watch:{rel_dir}", callback=self._job_done)
+
+    def _job_done(self, job):
+        incomplete = set()  # 任务中止时还没处理到的文档所在目录
+        with self._lock:
+            for item, result in zip(job.items, job.results):
+                rel_dir = os.path.relpath(item["target"], self.root)
+                if result["status"] in ("success", "skipped") or result.get("reason") in PERMANENT_FAILURES:
+                    self.state.setdefault(rel_dir, {})[item["doc_url"]] = item["name"]
+            for item in job.items[len(job.results):]:
+                incomplete.add(os.path.relpath(item["target"], self.root))
+            for item in job.items:
+                self.inflight.pop((os.path.relpath(item["target"], self.root), item["doc_url"]), None)
+            renamed = {d for d in self._stale if not any(key[0] == d for key in self.inflight)}
+            self._stale -= renamed
+        self._save_state()
+        
+        # 中止的任务稍后重试，处理中被改名的文档立即重新比对
+        for rel_dir in incomplete:
+            logging.info(f"🔁 {rel_dir}/data.json 中还有未处理的文档，{WATCH_RETRY_DELAY} 秒后重新比对")
+            self.mark_dirty(os.path.join(self.root, rel_dir, "data.json"), delay=WATCH_RETRY_DELAY)
+        for rel_dir in renamed - incomplete:
+            self.mark_dirty(os.path.join(self.root, rel_dir, "data.json"))
+
+
+def make_daemon_handler(service):
+    """生成守护进程的 HTTP 请求处理类"""
+
+    class DaemonHandler(BaseHTTPRequestHandler):
+        def _send_json(self, code, data):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split("?")[0].rstrip("/")
+            if path == "/metrics":
+                body = METRICS.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif path == "/health":
+                self._send_json(200, {"status": "ok", "workers": service.worker_count,
+                                      "queued": service.queue.qsize()})
+            elif path == "/debug":
+                self._send_json(200, DIAGNOSTICS.report([job.diagnostics for job in service.list()]))
+            elif path == "/jobs":
+                self._send_json(200, [job.to_dict(with_results=False) for job in service.list()])
+            elif path.startswith("/jobs/"):
+                job = service.get(path[len("/jobs/"):])
+                if job:
+                    self._send_json(200, job.to_dict())
+                else:
+                    self._send_json(404, {"error": "任务不存在"})
+            else:
+                self._send_json(404, {"error": "未知路径"})
+
+        def do_POST(self):
+            if self.path.split("?")[0].rstrip("/") != "/jobs":
+                self._send_json(404, {"error": "未知路径"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+                job = service.submit(payload)
+            except (ValueError, UnicodeDecodeError) as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            self._send_json(202, job.to_dict(with_results=False))
+
+        def log_message(self, format, *args):
+            pass
+
+    return DaemonHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def daemon_main(watch=False):
+    """守护进程模式：常驻浏览器，通过本地 HTTP 接口接收下载任务；watch 时同时监控 data.json"""
+    logging.info("=" * 80)
+    logging.info("🛰️  企业微信文档下载守护进程" + ("（监控模式）" if watch else ""))
+    logging.info("=" * 80)
+    logging.info(f"📁 根目录: {ROOT_DIRECTORY}")
+    
+    service = DownloadService()
+    try:
+        service.start()
+    except RuntimeError as e:
+        logging.error(f"❌ 守护进程启动失败: {e}")
+        service.stop()
+        return
+    
+    watcher = None
+    if watch:
+        watcher = DataJsonWatcher(service)
+        watcher.start()
+    
+    handler = make_daemon_handler(service)
+    if DAEMON_SOCKET:
+        if os.path.exists(DAEMON_SOCKET):
+            os.remove(DAEMON_SOCKET)
+        server = ThreadingUnixHTTPServer(DAEMON_SOCKET, handler)
+        address = f"unix://{DAEMON_SOCKET}"
+    else:
+        server = ThreadingHTTPServer((DAEMON_HOST, DAEMON_PORT), handler)
+        address = f"http://{DAEMON_HOST}:{DAEMON_PORT}"
+    
+    logging.info(f"✅ 守护进程已就绪: {address}")
+    logging.info("   POST /jobs 提交任务，GET /jobs/<id> 查询状态，GET /metrics 查看指标")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if DAEMON_SOCKET and os.path.exists(DAEMON_SOCKET):
+            os.remove(DAEMON_SOCKET)
+        if watcher:
+            watcher.stop()
+        service.stop()
 
 
 def main():
@@ -677,62 +2456,59 @@ def main():
         logging.error(f"❌ 根目录不存在: {ROOT_DIRECTORY}")
         return
     
+    METRICS.set("qiwei_run_start_timestamp_seconds", int(start_time))
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, METRICS_PORT)
+    
     # 查找所有包含data.json的目录
-    directories_with_data = []
-    logging.info("🔍 正在扫描目录...")
-    for root, dirs, files in os.walk(ROOT_DIRECTORY):
-        if "data.json" in files:
-            directories_with_data.append(root)
-            rel_path = os.path.relpath(root, ROOT_DIRECTORY)
-            logging.info(f"   ✓ 找到: {rel_path}")
+    directories_with_data = find_data_directories()
     
     if not directories_with_data:
         logging.warning("⚠️  未找到包含data.json的目录")
         return
     
-    # 按路径深度排序，确保先处理父目录
-    directories_with_data.sort(key=lambda x: x.count(os.sep))
+    METRICS.set("qiwei_directories", len(directories_with_data), state="total")
+    METRICS.set("qiwei_directories", 0, state="done")
     
     logging.info(f"\n✅ 找到 {len(directories_with_data)} 个包含data.json的目录:")
     for i, directory in enumerate(directories_with_data, 1):
         rel_path = os.path.relpath(directory, ROOT_DIRECTORY)
         logging.info(f"   {i}. {rel_path}")
     
+    # 根据耗时历史预估本次运行时间
+    history = TimingHistory(os.path.join(ROOT_DIRECTORY, TIMING_HISTORY_FILE))
+    pending = collect_pending(directories_with_data, history)
+    tracker = ProgressTracker(*history.plan(pending))
+    logging.info(f"\n🧮 待处理文档 {tracker.total} 个，预估耗时 {format_time(tracker.eta())}")
+    
+    directories_with_data = schedule_directories(directories_with_data, pending, history)
+    logging.info(f"📐 调度策略: {SCHEDULE_STRATEGY}" + ("（不稳定文档延后）" if DEFER_FLAKY else ""))
+    
     # 启动浏览器
     logging.info(f"\n{'='*80}")
     logging.info("🌐 正在启动浏览器...")
     logging.info("=" * 80)
-    driver = setup_browser(
-        ROOT_DIRECTORY,  # 初始下载目录设为根目录
-        use_profile=USE_REAL_PROFILE,
-        profile_path=CHROME_PROFILE_PATH,
-        profile_name=PROFILE_NAME
-    )
-    
-    # 如果不使用 profile，则需要加载 cookie
-    if not USE_REAL_PROFILE:
-        cookies_list = load_cookies_from_file(cookie_file) if os.path.exists(cookie_file) else []
-        if cookies_list:
-            logging.info(f"🔐 正在注入 {len(cookies_list)} 个 cookie...")
-            add_cookies(driver, cookies_list)
-        else:
-            logging.warning("⚠️  未提供 cookie 且未使用 profile，可能需要手动登录")
-            logging.info("👉 请在打开的浏览器中登录，然后按回车继续...")
-            input()
-    else:
-        logging.info("✅ 使用真实浏览器 Profile，已自动登录")
+    driver = start_browser_session()
+    session = SessionGuard()
     
     # 统计信息
     total_success = 0
     total_failed = 0
     total_skipped = 0
     directory_results = []
+    aborted = None
+    deferred_by_dir = {}  # 目录 -> 推迟到最后的 [(原序号, info), ...]
     
     # 处理每个目录
     for idx, directory in enumerate(directories_with_data, 1):
         try:
+            deferred = [] if DEFER_FLAKY else None
             # 调用 process_directory，确保总是返回4个值
-            result = process_directory(directory, driver, idx, len(directories_with_data))
+            result = process_directory(directory, driver, idx, len(directories_with_data),
+                                       history=history, tracker=tracker, session=session,
+                                       deferred=deferred)
+            if deferred:
+                deferred_by_dir[directory] = deferred
             
             # 检查返回值
             if result is None or len(result) != 4:
@@ -744,6 +2520,8 @@ def main():
             total_success += success
             total_failed += failed
             total_skipped += skipped
+            METRICS.add("qiwei_directories", 1, state="done")
+            tracker.complete_directory()
             
             directory_results.append({
                 'directory': os.path.relpath(directory, ROOT_DIRECTORY),
@@ -755,19 +2533,27 @@ def main():
             
             # 显示总体进度
             logging.info(f"\n{'='*80}")
-            print_progress_bar(idx, len(directories_with_data), prefix='🎯 总体进度')
+            print_progress_bar(idx, len(directories_with_data), prefix='🎯 总体进度',
+                               suffix=tracker.summary())
             logging.info(f"📊 累计统计: 成功 {total_success} | 跳过 {total_skipped} | 失败 {total_failed}")
             logging.info(f"{'='*80}")
             
+            if status == SESSION_EXPIRED_STATUS:
+                aborted = SESSION_EXPIRED_STATUS
+                logging.error("🛑 登录已失效，终止本次运行（更新 cookie 后重新运行即可从断点继续）")
+                break
+            
             # 目录间休息
             if idx < len(directories_with_data):
-                logging.info(f"\n⏸️  休息 3 秒后处理下一个目录...")
-                time.sleep(3)
+                logging.info(f"\n⏸️  休息 {DIR_INTERVAL_WAIT} 秒后处理下一个目录...")
+                time.sleep(DIR_INTERVAL_WAIT)
                 
         except Exception as e:
             logging.error(f"❌ 处理目录 {directory} 时发生异常: {e}")
             import traceback
             logging.error(traceback.format_exc())
+            METRICS.add("qiwei_directories", 1, state="done")
+            tracker.complete_directory()
             
             directory_results.append({
                 'directory': os.path.relpath(directory, ROOT_DIRECTORY),
@@ -777,15 +2563,50 @@ def main():
                 'status': f"异常: {str(e)}"
             })
     
+    # 最后处理推迟的不稳定文档
+    if deferred_by_dir and not aborted:
+        logging.info(f"\n{'='*80}")
+        logging.info(f"🔁 处理推迟的不稳定文档: {sum(len(v) for v in deferred_by_dir.values())} 个")
+        for idx, (directory, entries) in enumerate(deferred_by_dir.items(), 1):
+            try:
+                success, failed, skipped, status = process_directory(
+                    directory, driver, idx, len(deferred_by_dir),
+                    history=history, tracker=tracker, session=session, entries=entries)
+            except Exception as e:
+                logging.error(f"❌ 处理目录 {directory} 的推迟文档时发生异常: {e}")
+                success, failed, skipped, status = 0, 0, 0, f"异常: {str(e)}"
+            
+            total_success += success
+            total_failed += failed
+            total_skipped += skipped
+            rel_dir = os.path.relpath(directory, ROOT_DIRECTORY)
+            for result in directory_results:
+                if result['directory'] == rel_dir:
+                    result['success'] += success
+                    result['failed'] += failed
+                    result['skipped'] += skipped
+                    if status != "完成":
+                        result['status'] = status
+            
+            if status == SESSION_EXPIRED_STATUS:
+                aborted = SESSION_EXPIRED_STATUS
+                logging.error("🛑 登录已失效，终止本次运行（更新 cookie 后重新运行即可从断点继续）")
+                break
+    
     driver.quit()
     logging.info("\n🔒 浏览器已关闭")
+    history.save()
+    DIAGNOSTICS.flush()
     
     # 计算总耗时
     total_time = time.time() - start_time
     
     # 最终统计
     logging.info(f"\n{'='*80}")
-    logging.info("🎉 全部处理完成！")
+    if aborted:
+        logging.info(f"🛑 运行已中止: {aborted}")
+    else:
+        logging.info("🎉 全部处理完成！")
     logging.info("=" * 80)
     logging.info(f"⏰ 结束时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     logging.info(f"⏱️  总耗时: {format_time(total_time)}")
@@ -840,7 +2661,9 @@ def main():
                 "total_failed": total_failed,
                 "total_skipped": total_skipped,
                 "total_directories": len(directories_with_data),
-                "directory_results": directory_results
+                "aborted": aborted,
+                "directory_results": directory_results,
+                "debug_artifacts": DIAGNOSTICS.report()
             }, f, ensure_ascii=False, indent=2)
         logging.info(f"\n💾 结果已保存到: {result_file}")
     except Exception as e:
@@ -856,7 +2679,12 @@ def main():
 
 if __name__ == "__main__":
     try:
-        main()
+        if RUN_MODE == "plan":
+            plan_run()
+        elif RUN_MODE in ("daemon", "watch"):
+            daemon_main(watch=(RUN_MODE == "watch"))
+        else:
+            main()
     except KeyboardInterrupt:
         logging.info("\n\n⚠️  用户中断程序")
     except Exception as e: